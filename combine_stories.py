@@ -5,10 +5,13 @@ This script joins stories from different files, removing duplicates.
 
 __author__ = 'Lex Darlog (DRL)'
 
+import sys as _sys
 import typing as _t
 import re as _re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from itertools import chain
+from itertools import chain, islice
 
 
 TextLines = _t.List[str]
@@ -16,9 +19,59 @@ TextLinesIter = _t.Iterable[str]
 StoryVariants = _t.List[TextLines]
 
 
-def reversed_int_indices(size):
-	"""An iterator over list indices, in reversed order."""
-	return range(size - 1, -1, -1)
+def batched_lines(lines: TextLinesIter, batch_size: int = 4096):
+	"""Split an iterable of lines into list-chunks of the given size."""
+	lines = iter(lines)
+	while True:
+		chunk = list(islice(lines, batch_size))
+		if not chunk:
+			return
+		yield chunk
+
+
+def key_line_replacer_f(*args):
+	"""
+	A factory that returns a function that performs a specific replacement
+	on a single key line, or None if wrong arguments are given.
+	Args are story_id_cleanup items.
+	"""
+	n = len(args)
+	if n < 1:
+		return None
+
+	pattern: _t.Union[_t.Pattern, str] = args[0]
+	repl: str = '' if n < 2 else args[1]
+	do_loop: bool = False if n < 3 else args[2]
+
+	# simple case: basic string replacement
+	if isinstance(pattern, str):
+		def simple_no_loop(line: str):
+			return line.replace(pattern, repl)
+
+		def simple_with_loop(line: str):
+			while pattern in line:
+				line = line.replace(pattern, repl)
+			return line
+
+		return simple_with_loop if do_loop else simple_no_loop
+
+	# complex case - regex:
+	try:
+		sub = pattern.sub
+	except:
+		return None
+
+	def re_no_loop(line: str):
+		return sub(repl, line)
+
+	def re_with_loop(line: str):
+		prev_line = ''
+		while prev_line != line:
+			prev_line = line
+			line = sub(repl, line)
+		return line
+
+	return re_with_loop if do_loop else re_no_loop
 
 
 class StoriesDatabase(_t.Dict[str, StoryVariants]):
@@ -144,24 +197,25 @@ class StoriesDatabase(_t.Dict[str, StoryVariants]):
 
 	def append_new_empty_variant(self, story_name: str):
 		"""Adds a new empty variant for the given story."""
-		if story_name not in self:
-			self[story_name]: StoryVariants = list()
-		variants = self[story_name]
+		# the same story names recur across many files; interning them keeps
+		# a single copy of each and makes the dict lookups pointer-compares:
+		story_name = _sys.intern(story_name)
+		variants: StoryVariants = self.setdefault(story_name, list())
 		cur_variant: TextLines = list()
 		variants.append(cur_variant)
 		return cur_variant
 
-	def parse_text(self, text_lines: TextLines):
+	def parse_text(self, text_lines: TextLinesIter):
 		"""Parse a chunk of text for individual stories and append them."""
 
 		if not text_lines:
 			return 0
 
 		def remove_trailing_empty_lines(story: TextLines):
-			for last_line in reversed(story):
-				if last_line:
-					break
-				story.pop()
+			i = len(story)
+			while i and not story[i - 1]:
+				i -= 1
+			del story[i:]
 
 		story_name_matcher: _t.Callable[[str], _t.Match] = self.story_name_pattern.match
 
@@ -175,7 +229,12 @@ class StoriesDatabase(_t.Dict[str, StoryVariants]):
 
 		for line in text_lines:
 			line = line.strip()
-			name_match = story_name_matcher(line)
+			# The vast majority of lines can't be a story name: after the strip,
+			# a name line always starts with dashes. So do a cheap C-level check
+			# first and query the regex engine only when it has a chance to match:
+			name_match = None
+			if line.startswith('-') and '---' in line:
+				name_match = story_name_matcher(line)
 			if name_match or not_in_story_yet:
 				story_name = ''
 				if name_match:
@@ -222,9 +281,11 @@ class StoriesDatabase(_t.Dict[str, StoryVariants]):
 		if not file_path:
 			return 0
 
-		with file_path.open('rt', encoding='UTF-8') as f:
-			file_lines = f.readlines()
-		return self.parse_text(file_lines)
+		# feed the file handle to the parser directly: the algorithm is strictly
+		# a single forward pass, so there's no need to materialize all the lines
+		# at once. This keeps peak memory at O(single story), not O(whole file).
+		with file_path.open('rt', encoding='UTF-8', buffering=1 << 20) as f:
+			return self.parse_text(f)
 
 	def parse_files(self, file_paths: _t.Iterable[Path], ext=None):
 		"""
@@ -243,16 +304,34 @@ class StoriesDatabase(_t.Dict[str, StoryVariants]):
 		if not ext_set:
 			ext_set = {'.txt', }
 
-		file_paths = (
+		file_paths = [
 			path for path in file_paths
 			if path.is_file() and path.suffix.lower() in ext_set
-		)
-		if self.print_progress:
-			file_paths = list(file_paths)
-			if not file_paths:
-				print('\tNo valid file paths!')
+		]
+		if self.print_progress and not file_paths:
+			print('\tNo valid file paths!')
 
-		return sum(map(self.parse_file, file_paths))
+		if len(file_paths) < 2:
+			return sum(map(self.parse_file, file_paths))
+
+		# the per-line parse work is CPU-bound in the regex/cleanup code, so
+		# spread the files across worker processes and merge the partial DBs
+		# back in the original file order (the order matters: it defines which
+		# duplicate of a story is kept as "the first one").
+		n_vars_total = 0
+		with ProcessPoolExecutor() as pool:
+			for file_path, (partial_db, n_vars) in zip(
+				file_paths,
+				pool.map(partial(_parse_file_to_db, type(self)), file_paths)
+			):
+				if self.print_progress:
+					print('\t{}'.format(file_path))
+				for story_name, variants in partial_db.items():
+					# the unpickled worker strings aren't interned, so re-intern
+					# here - same as append_new_empty_variant does when parsing:
+					self.setdefault(_sys.intern(story_name), list()).extend(variants)
+				n_vars_total += n_vars
+		return n_vars_total
 
 	def parse_dir(self, dir_path: Path = None):
 		if not dir_path:
@@ -270,10 +349,117 @@ class StoriesDatabase(_t.Dict[str, StoryVariants]):
 			print('Reading all the text files from dir: {}'.format(dir_path))
 		return self.parse_files(dir_path.iterdir())
 
+	@classmethod
+	def _html_chars_replacer(cls):
+		"""
+		A function replacing all the html_chars_map codes in a single line.
+		The map is fused into one alternation regex - a single C-level pass
+		over each line instead of a pass per char-code - compiled only once
+		(per class) and cached. None if the map is empty.
+		"""
+		cached = cls.__dict__.get('_html_chars_replacer_cache')
+		if cached is not None:
+			return cached[0]
+
+		html_chars_dict: _t.Dict[str, str] = {
+			src: repl
+			for src, repl, *buffer in cls.html_chars_map
+		}
+		replacer_f = None
+		if html_chars_dict:
+			pattern_sub = _re.compile('|'.join(
+				_re.escape(src) for src in html_chars_dict
+			)).sub
+			html_chars_get = html_chars_dict.get
+
+			def replace_match(match: _t.Match):
+				return html_chars_get(match.group(0), '')
+
+			def replacer_f(line: str):
+				return pattern_sub(replace_match, line)
+
+		# the cache is a tuple, since the cached value itself might be None:
+		cls._html_chars_replacer_cache = (replacer_f, )
+		return replacer_f
+
+	@classmethod
+	def _code_pattern_multiline(cls):
+		"""
+		A multiline version of code_pattern, anchored to line starts.
+		Derived from code_pattern once (per class) and cached.
+		"""
+		pattern = cls.__dict__.get('_code_pattern_ml_cache')
+		if pattern is None:
+			# keep the source pattern's flags (a subclass might compile
+			# code_pattern with, say, IGNORECASE):
+			pattern = _re.compile(
+				'(?m)^' + cls.code_pattern.pattern, cls.code_pattern.flags
+			)
+			cls._code_pattern_ml_cache = pattern
+		return pattern
+
 	def is_code_story(self, story: _t.Iterable[str]):
 		"""Whether the given story has some garbage code from scrape."""
-		matcher = self.code_pattern.match
-		return any(matcher(line) for line in story)
+		# one C-level scan over the joined text instead of a Python-level
+		# regex call per line:
+		return self._code_pattern_multiline().search('\n'.join(story)) is not None
+
+	@classmethod
+	def _id_cleanup_funcs(cls):
+		"""
+		The story_id_cleanup rules, compiled to replacer functions.
+		The compilation is done only once (per class) and cached,
+		since the rules themselves are class-level config.
+		"""
+		# look the cache up on this exact class, so a subclass with its own
+		# story_id_cleanup re-compiles instead of inheriting a stale cache:
+		funcs = cls.__dict__.get('_id_cleanup_funcs_cache')
+		if funcs is not None:
+			return funcs
+
+		funcs = list()
+		char_map: _t.Dict[str, str] = dict()
+
+		def flush_char_map():
+			if not char_map:
+				return
+			table = str.maketrans(dict(char_map))
+
+			def translate_f(line: str, _table=table):
+				return line.translate(_table)
+
+			funcs.append(translate_f)
+			char_map.clear()
+
+		for cleanup_args in cls.story_id_cleanup:
+			args = tuple(cleanup_args)
+			if (
+				len(args) > 1
+				and isinstance(args[0], str) and len(args[0]) == 1
+				and isinstance(args[1], str)
+				and not (len(args) > 2 and args[2])
+			):
+				# Single-char non-looped replacements are fused into one
+				# translate() call - i.e., one C-level pass instead of a pass
+				# per rule. It's only valid while the fused rules can't interact,
+				# so flush the accumulated table whenever they could:
+				pattern, repl = args[0], args[1]
+				if pattern in char_map or any(
+					pattern in prev_repl for prev_repl in char_map.values()
+				):
+					flush_char_map()
+				char_map[pattern] = repl
+				continue
+
+			flush_char_map()
+			replacer_f = key_line_replacer_f(*args)
+			if replacer_f is not None:
+				funcs.append(replacer_f)
+		flush_char_map()
+
+		funcs = tuple(funcs)
+		cls._id_cleanup_funcs_cache = funcs
+		return funcs
 
 	def cleanup_stories(self):
 		"""
@@ -288,123 +474,76 @@ class StoriesDatabase(_t.Dict[str, StoryVariants]):
 		messed up, you better of cleaning it yourself before passing it to this class.
 		"""
 
-		def key_line_replacer_f(*args):
-			"""
-			A factory that returns a function that performs a specific replacement
-			on a single key line, or None if wrong arguments are given.
-			Args are story_id_cleanup items.
-			"""
-			n = len(args)
-			if n < 1:
-				return None
-
-			pattern: _t.Union[_t.Pattern, str] = args[0]
-			repl: str = '' if n < 2 else args[1]
-			do_loop: bool = False if n < 3 else args[2]
-
-			# simple case: basic string replacement
-			if isinstance(pattern, str):
-				def simple_no_loop(line: str):
-					return line.replace(pattern, repl)
-
-				def simple_with_loop(line: str):
-					while pattern in line:
-						line = line.replace(pattern, repl)
-					return line
-
-				return simple_with_loop if do_loop else simple_no_loop
-
-			# complex case - regex:
-			try:
-				sub = pattern.sub
-			except:
-				return None
-
-			def re_no_loop(line: str):
-				return sub(repl, line)
-
-			def re_with_loop(line: str):
-				prev_line = ''
-				while prev_line != line:
-					prev_line = line
-					line = sub(repl, line)
-				return line
-
-			return re_with_loop if do_loop else re_no_loop
+		id_cleanup_funcs = self._id_cleanup_funcs()
 
 		def story_identifier_key(story_variant: TextLinesIter):
 			"""
 			Hashable text of the whole story, without any empty lines or
 			leading/trailing whitespaces.
-			"""
-			for cleanup_args in self.story_id_cleanup:
-				replacer_f = key_line_replacer_f(*cleanup_args)
-				if replacer_f is None:
-					continue
-				story_variant = map(replacer_f, story_variant)
 
-			return tuple(filter(None, story_variant))
-
-		def replace_html_chars_single_line_dec(do_replace: bool):
-			"""
-			Conditionally add html-chars replacement after the main cleanup func.
+			A single joined string is used instead of a tuple of lines:
+			it's one object per variant instead of many, and hashing/comparing it
+			is a single C-level pass over the text.
 			"""
-			def decorator(f: _t.Callable[[str], str]):
-				# cache as tuple of tuples - for some perf optimization
-				html_chars_map: _t.Tuple[_t.Tuple[str, str], ...] = tuple(
-					(src, repl)
-					for src, repl, *buffer in self.html_chars_map
-				)
-
-				def wrapper(line: str):
-					line = f(line)
-					for char_code, out_char in html_chars_map:
-						line = line.replace(char_code, out_char)
-					return line
-
-				return wrapper if do_replace else f
-			return decorator
-
-		@replace_html_chars_single_line_dec(self.html_chars_replace)
-		def cleanup_single_line(line: str):
-			return line.strip()
+			# a plain loop into a list instead of a stack of chained map()
+			# iterators: no per-rule iterator objects, no generator resumes,
+			# and join() gets a real list it can pre-size for:
+			key_lines = []
+			key_lines_append = key_lines.append
+			for line in story_variant:
+				for replacer_f in id_cleanup_funcs:
+					line = replacer_f(line)
+				if line:
+					key_lines_append(line)
+			return '\n'.join(key_lines)
+
+		cleanup_single_line: _t.Callable[[str], str] = (
+			self._html_chars_replacer() if self.html_chars_replace else None
+		)
+		if cleanup_single_line is None:
+			def cleanup_single_line(line: str):
+				# no replacement to do: the lines are already stripped at parse
+				# time (parse_text strips each one on ingest)
+				return line
 
-		empty_story_key = tuple()
+		empty_story_key = ''
 
 		for story_variants in self.values():
-			story_variants_clean = tuple(
-				[cleanup_single_line(ln) for ln in variant_text]
-				for variant_text in story_variants
-			)
-			unique_variants_dict: _t.Dict[_t.Tuple[str, ...], int] = {
-				story_identifier_key(story_variants_clean[i]): i
-				for i in reversed_int_indices(len(story_variants_clean))
-				# we need to iterate variants ^ in reversed order to keep the first
-				# duplicates, not the last ones
-			}
-			if empty_story_key in unique_variants_dict:
-				unique_variants_dict.pop(empty_story_key)
+			# A single pass over the variants, cleaning each one lazily and
+			# keeping only the first variant per unique id-key (the forward scan
+			# makes the first duplicate win naturally, and the dict's insertion
+			# order keeps the original variants order - no re-sorting needed).
+			# Unlike with a pre-built cleaned copy of the whole story, duplicates
+			# are dropped right away and never held in memory.
+			unique_variants_dict: _t.Dict[str, TextLines] = dict()
+			# scrapes are full of byte-identical duplicates; they're guaranteed
+			# to produce the same id-key, so don't even run the cleanup pipeline
+			# for them:
+			seen_raw_variants: _t.Set[_t.Tuple[str, ...]] = set()
+			seen_raw_add = seen_raw_variants.add
+			for variant_text in story_variants:
+				raw_key = tuple(variant_text)
+				if raw_key in seen_raw_variants:
+					continue
+				seen_raw_add(raw_key)
+				variant_clean = [cleanup_single_line(ln) for ln in variant_text]
+				id_key = story_identifier_key(variant_clean)
+				if id_key not in unique_variants_dict:
+					unique_variants_dict[id_key] = variant_clean
+			unique_variants_dict.pop(empty_story_key, None)
 
 			if self.remove_code:
-				for story_id_tuple in list(unique_variants_dict.keys()):
-					story_i = unique_variants_dict[story_id_tuple]
-					# The id-tuple may be cleaned up 'too much', containing some
+				for story_id_key in list(unique_variants_dict.keys()):
+					# The id-key may be cleaned up 'too much', containing some
 					# messed-up brackets, so we need to check the actual clean story,
-					# not id-tuple:
-					if self.is_code_story(story_variants_clean[story_i]):
-						unique_variants_dict.pop(story_id_tuple)
+					# not id-key:
+					if self.is_code_story(unique_variants_dict[story_id_key]):
+						unique_variants_dict.pop(story_id_key)
 
-			if len(story_variants_clean) == len(unique_variants_dict):
+			if len(story_variants) == len(unique_variants_dict):
 				continue
 
-			id_to_unique_text_tuple_map: _t.Dict[int, _t.Tuple[str, ...]] = {
-				i: id_tuple for id_tuple, i in unique_variants_dict.items()
-			}
-			story_variants[:] = (
-				story_variants_clean[var_i]
-				for var_i, text_tuple in sorted(id_to_unique_text_tuple_map.items())
-				if any(line for line in text_tuple)
-			)
+			story_variants[:] = unique_variants_dict.values()
 
 		# we have removed all the empty variants. Now, let's also remove all the
 		# stories with no variants left there:
@@ -412,6 +551,7 @@ class StoriesDatabase(_t.Dict[str, StoryVariants]):
 			# we need to apply the same line-cleanup to the story names themselves:
 			clean_name = cleanup_single_line(story_name)
 			if clean_name != story_name:
+				clean_name = _sys.intern(clean_name)
 				self[clean_name] = self.pop(story_name)
 				story_name = clean_name
 
@@ -431,6 +571,13 @@ class StoriesDatabase(_t.Dict[str, StoryVariants]):
 		lines_after_title = ['', ] * self.out_empty_lines_after_title
 		lines_after_story = ['', ] * self.out_empty_lines_after_story
 
+		# hoist all the attribute reads out of the per-variant hot path,
+		# binding the format methods themselves as locals:
+		unnamed_key = self.unnamed_story_key
+		unnamed_name_format = self.unnamed_story_name_out_format.format
+		multi_variant_format = self.multi_variant_name_format.format
+		out_name_format = self.out_story_name_format.format
+
 		def single_story_text(story_formatted_name: str, story_lines: TextLines):
 			return chain(
 				[story_formatted_name],
@@ -440,24 +587,28 @@ class StoriesDatabase(_t.Dict[str, StoryVariants]):
 			)
 
 		def format_story_name(story_name: str, variant_i: int, num_vars: int):
-			if story_name == self.unnamed_story_key:
-				story_name = self.unnamed_story_name_out_format.format(
+			if story_name == unnamed_key:
+				story_name = unnamed_name_format(
 					name=story_name,
 					i=variant_i,
 				)
 			elif num_vars > 1:
-				story_name = self.multi_variant_name_format.format(
+				story_name = multi_variant_format(
 					name=story_name,
 					i=variant_i,
 				)
-			return self.out_story_name_format.format(story_name=story_name)
+			return out_name_format(story_name=story_name)
 
+		# sort only the keys: no need to build (and sort) a whole
+		# list of (name, variants) tuples just to iterate it once
 		return chain(*(
 			single_story_text(
 				format_story_name(name, var_i, len(story_variants)),
 				var_text
 			)
-			for name, story_variants in sorted(self.items())
+			for name, story_variants in (
+				(nm, self[nm]) for nm in sorted(self)
+			)
 			for var_i, var_text in enumerate(story_variants)
 			if var_text
 		))
@@ -475,8 +626,26 @@ class StoriesDatabase(_t.Dict[str, StoryVariants]):
 		if self.print_progress:
 			print('Saving to a single file with no duplicates: {}'.format(out_file))
 
+		# join + write in big chunks: the per-chunk join is a single C-level
+		# pass and the writes stay large and sequential, while the full output
+		# text is never held in memory at once.
 		with out_file.open('wt', encoding='UTF-8', newline='\n') as f:
-			f.writelines(ln + '\n' for ln in self.combined_text())
+			for chunk in batched_lines(self.combined_text()):
+				f.write('\n'.join(chunk))
+				f.write('\n')
+
+
+def _parse_file_to_db(cls: _t.Type[StoriesDatabase], file_path: Path):
+	"""
+	A worker for parallel parsing: reads a single file into a fresh database
+	of the given class (so subclasses with overridden config parse correctly).
+	Returns the parsed stories as a plain dict (picklable) and the number
+	of extracted variants.
+	"""
+	db = cls()
+	db.print_progress = False
+	n_vars = db.parse_file(file_path)
+	return dict(db), n_vars
 
 
 if __name__ == '__main__':